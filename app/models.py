@@ -1,13 +1,17 @@
-from datetime import date, datetime
+from datetime import date, datetime, timezone
 from decimal import Decimal
 from typing import Optional
 
-from sqlalchemy import Boolean, Date, DateTime, ForeignKey, Integer, Numeric, String, Text
+from sqlalchemy import Boolean, Date, DateTime, ForeignKey, Index, Integer, Numeric, String, Text, func, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.db import Base
 
 
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 class Apartment(Base):
     __tablename__ = "apartments"
 
@@ -31,18 +35,23 @@ class UtilityType(Base):
 
 class UtilityBill(Base):
     __tablename__ = "utility_bills"
+    __table_args__ = (
+        Index("ix_utility_bills_consumption_month_utility_type", "consumption_month", "utility_type"),
+        Index("ix_utility_bills_billing_month_utility_type", "billing_month", "utility_type"),
+        Index("ix_utility_bills_received_date_id", "received_date", "id"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     apartment_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("apartments.id"), nullable=True, index=True)
-    utility_type: Mapped[str] = mapped_column(String(50), ForeignKey("utility_types.code"), nullable=False, index=True)
-    consumption_month: Mapped[date] = mapped_column(Date, nullable=False, index=True)
+    utility_type: Mapped[str] = mapped_column(String(50), ForeignKey("utility_types.code"), nullable=False)
+    consumption_month: Mapped[date] = mapped_column(Date, nullable=False)
     received_date: Mapped[date] = mapped_column(Date, nullable=False)
     amount: Mapped[Decimal] = mapped_column(Numeric(12, 2), nullable=False)
-    billing_month: Mapped[date] = mapped_column(Date, nullable=False, index=True)
+    billing_month: Mapped[date] = mapped_column(Date, nullable=False)
     is_paid: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
     paid_date: Mapped[Optional[date]] = mapped_column(Date, nullable=True)
     note: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=utc_now, server_default=func.current_timestamp(), nullable=False)
 
     utility: Mapped[UtilityType] = relationship(back_populates="bills")
     apartment: Mapped[Optional[Apartment]] = relationship(back_populates="bills")
@@ -50,6 +59,7 @@ class UtilityBill(Base):
 
 class BillingMonth(Base):
     __tablename__ = "billing_months"
+    __table_args__ = (Index("ix_billing_months_closed", "billing_month", sqlite_where=text("is_closed = 1")),)
 
     billing_month: Mapped[date] = mapped_column(Date, primary_key=True)
     is_closed: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
@@ -62,4 +72,4 @@ class Setting(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     rent_amount: Mapped[Decimal] = mapped_column(Numeric(12, 2), default=Decimal("0.00"), nullable=False)
     billing_day: Mapped[int] = mapped_column(Integer, default=10, nullable=False)
-    active_year: Mapped[int] = mapped_column(Integer, default=lambda: date.today().year, nullable=False)
+    active_year: Mapped[int] = mapped_column(Integer, nullable=False)
@@ -1,19 +1,24 @@
 from __future__ import annotations
 
+import functools
+import itertools
 import os
-import shutil
+import sqlite3
 import sys
+import time
+from contextlib import closing
 from dataclasses import dataclass
-from datetime import date, datetime
+from datetime import date
 from decimal import Decimal
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
 
-from sqlalchemy import Select, case, func, inspect, select, text
+from sqlalchemy import Select, case, event, func, inspect, select, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session, joinedload
 
-from app.db import DB_PATH, Base, engine
-from app.models import Apartment, BillingMonth, Setting, UtilityBill, UtilityType
+from app.db import DB_PATH, Base, SessionLocal, engine
+from app.models import Apartment, BillingMonth, Setting, UtilityBill, UtilityType, utc_now
 
 HR_MONTHS = [
     "siječanj",
@@ -30,6 +35,45 @@ HR_MONTHS = [
     "prosinac",
 ]
 
+DEFAULT_UTILITY_TYPES = [
+    ("electricity", "Električna energija"),
+    ("water", "Voda"),
+    ("gas", "Plin"),
+    ("waste", "Odvoz otpada"),
+]
+
+SCHEMA_VERSION = 4
+
+_SETTINGS_STMT = select(Setting).limit(1)
+_BILLS_STMT = select(UtilityBill).options(joinedload(UtilityBill.utility)).order_by(UtilityBill.received_date.desc(), UtilityBill.id.desc())
+_CLOSED_MONTHS_STMT = select(BillingMonth.billing_month).where(BillingMonth.is_closed)
+_ACTIVE_UTILITY_TYPES_STMT = select(UtilityType).where(UtilityType.is_active.is_(True)).order_by(UtilityType.name_hr)
+
+_MONEY_TRANSLATION = str.maketrans({".": ","})
+
+_BOOT_ID = format(time.time_ns(), "x")
+_data_versions = itertools.count(1)
+_data_version = 0
+_settings_version = 0
+_settings_cache: Optional[tuple[int, SettingsSnapshot]] = None
+_lookups_version = 0
+_active_keys_cache: Optional[tuple[int, ActiveKeys]] = None
+
+
+@dataclass(frozen=True)
+class SettingsSnapshot:
+    id: int
+    rent_amount: Decimal
+    billing_day: int
+    active_year: int
+
+
+@dataclass(frozen=True)
+class ActiveKeys:
+    utility_names: tuple[tuple[str, str], ...]
+    utility_codes: frozenset[str]
+    apartment_ids: frozenset[int]
+
 
 @dataclass
 class ExpectedRow:
@@ -41,50 +85,47 @@ class ExpectedRow:
     charged: bool
 
 
-def first_of_month(value: date) -> date:
-    return value.replace(day=1)
+def _month_ordinal(value: date) -> int:
+    return value.year * 12 + value.month - 1
+
+
+def _month_from_ordinal(ordinal: int) -> date:
+    return date(ordinal // 12, ordinal % 12 + 1, 1)
 
 
 def next_month(value: date) -> date:
-    if value.month == 12:
-        return date(value.year + 1, 1, 1)
-    return date(value.year, value.month + 1, 1)
+    return _month_from_ordinal(_month_ordinal(value) + 1)
 
 
 def prev_month(value: date) -> date:
-    if value.month == 1:
-        return date(value.year - 1, 12, 1)
-    return date(value.year, value.month - 1, 1)
+    return _month_from_ordinal(_month_ordinal(value) - 1)
 
 
+@functools.lru_cache(maxsize=512)
 def month_label_hr(value: date) -> str:
     return f"{HR_MONTHS[value.month - 1]}-{value.year}"
 
 
+@functools.lru_cache(maxsize=2048)
 def format_date_hr(value: Optional[date]) -> str:
     if not value:
         return ""
-    return value.strftime("%d.%m.%Y")
+    return f"{value.day:02d}.{value.month:02d}.{value.year:04d}"
 
 
+@functools.lru_cache(maxsize=2048)
 def format_money_hr(value: Optional[Decimal]) -> str:
     if value is None:
         return "0,00"
-    return f"{value:.2f}".replace(".", ",")
+    return format(value, ".2f").translate(_MONEY_TRANSLATION)
 
 
 def compute_billing_month(received_date: date, billing_day: int) -> date:
-    month = first_of_month(received_date)
-    if received_date.day <= billing_day:
-        return month
-    return next_month(month)
+    return _month_from_ordinal(_month_ordinal(received_date) + (received_date.day > billing_day))
 
 
 def current_billing_month(today: date, billing_day: int) -> date:
-    month = first_of_month(today)
-    if today.day <= billing_day:
-        return month
-    return next_month(month)
+    return _month_from_ordinal(_month_ordinal(today) + (today.day > billing_day))
 
 
 def init_db(session: Session) -> None:
@@ -96,38 +137,106 @@ def init_db(session: Session) -> None:
         with engine.begin() as conn:
             conn.execute(text("ALTER TABLE utility_bills ADD COLUMN apartment_id INTEGER"))
             conn.execute(text("CREATE INDEX IF NOT EXISTS ix_utility_bills_apartment_id ON utility_bills(apartment_id)"))
-
-    has_settings = session.scalar(select(func.count()).select_from(Setting))
-    if not has_settings:
-        session.add(Setting(rent_amount=Decimal("0.00"), billing_day=10, active_year=date.today().year))
-
-    has_default_apartment = session.scalar(select(func.count()).select_from(Apartment))
-    if not has_default_apartment:
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_utility_bills_consumption_month_utility_type ON utility_bills(consumption_month, utility_type)"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_utility_bills_utility_type_consumption_month"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_utility_bills_utility_type"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_utility_bills_consumption_month"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_utility_bills_billing_month_utility_type ON utility_bills(billing_month, utility_type)"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_utility_bills_billing_month"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_utility_bills_received_date_id ON utility_bills(received_date, id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_billing_months_closed ON billing_months(billing_month) WHERE is_closed = 1"))
+
+    session.execute(
+        sqlite_insert(Setting)
+        .values(id=1, rent_amount=Decimal("0.00"), billing_day=10, active_year=date.today().year)
+        .on_conflict_do_nothing(index_elements=["id"])
+    )
+
+    has_default_apartment = session.scalar(select(Apartment.id).limit(1))
+    if has_default_apartment is None:
         session.add(Apartment(name="Stan 1", is_active=True))
         session.flush()
 
     default_apartment = session.scalar(select(Apartment).order_by(Apartment.id).limit(1))
     if default_apartment is not None:
-        bills_without_apartment = session.scalars(select(UtilityBill).where(UtilityBill.apartment_id.is_(None))).all()
-        for bill in bills_without_apartment:
-            bill.apartment_id = default_apartment.id
-
-    for code, name in [
-        ("electricity", "Električna energija"),
-        ("water", "Voda"),
-        ("gas", "Plin"),
-        ("waste", "Odvoz otpada"),
-    ]:
-        exists = session.scalar(select(func.count()).select_from(UtilityType).where(UtilityType.code == code))
-        if not exists:
-            session.add(UtilityType(code=code, name_hr=name, is_active=True))
+        session.execute(
+            update(UtilityBill).where(UtilityBill.apartment_id.is_(None)).values(apartment_id=default_apartment.id),
+            execution_options={"synchronize_session": False},
+        )
+
+    session.execute(
+        sqlite_insert(UtilityType)
+        .values([{"code": code, "name_hr": name, "is_active": True} for code, name in DEFAULT_UTILITY_TYPES])
+        .on_conflict_do_nothing(index_elements=["code"])
+    )
     session.commit()
+    session.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+    session.commit()
+
 
+def needs_init(session: Session) -> bool:
+    return session.scalar(text("PRAGMA user_version")) != SCHEMA_VERSION
 
-def get_settings(session: Session) -> Setting:
-    settings = session.scalar(select(Setting).limit(1))
+
+def invalidate_data_etag() -> None:
+    global _data_version
+    _data_version = next(_data_versions)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _invalidate_data_etag_on_commit(_session: Session) -> None:
+    invalidate_data_etag()
+
+
+def data_etag() -> str:
+    return f'W/"{_BOOT_ID}-{_data_version}-{_settings_version}-{_lookups_version}"'
+
+
+def get_settings(session: Session) -> SettingsSnapshot:
+    global _settings_cache
+    cached = _settings_cache
+    if cached is not None and cached[0] == _settings_version:
+        return cached[1]
+    version = _settings_version
+    settings = session.scalar(_SETTINGS_STMT)
     assert settings is not None
-    return settings
+    snapshot = SettingsSnapshot(
+        id=settings.id,
+        rent_amount=settings.rent_amount,
+        billing_day=settings.billing_day,
+        active_year=settings.active_year,
+    )
+    _settings_cache = (version, snapshot)
+    return snapshot
+
+
+def invalidate_settings() -> None:
+    global _settings_version
+    _settings_version += 1
+
+
+def get_active_keys(session: Session) -> ActiveKeys:
+    global _active_keys_cache
+    cached = _active_keys_cache
+    if cached is not None and cached[0] == _lookups_version:
+        return cached[1]
+    version = _lookups_version
+    utility_names = tuple(
+        (code, name) for code, name in session.execute(select(UtilityType.code, UtilityType.name_hr).where(UtilityType.is_active.is_(True)).order_by(UtilityType.name_hr))
+    )
+    keys = ActiveKeys(
+        utility_names=utility_names,
+        utility_codes=frozenset(code for code, _ in utility_names),
+        apartment_ids=frozenset(session.scalars(select(Apartment.id).where(Apartment.is_active.is_(True)))),
+    )
+    _active_keys_cache = (version, keys)
+    return keys
+
+
+def invalidate_lookups() -> None:
+    global _lookups_version
+    _lookups_version += 1
 
 
 def validate_month_first(value: date) -> bool:
@@ -143,49 +252,73 @@ def ensure_billing_month(session: Session, month: date) -> BillingMonth:
     return billing
 
 
+def get_closed_months(session: Session) -> frozenset[date]:
+    return frozenset(session.scalars(_CLOSED_MONTHS_STMT))
+
+
 def bills_query() -> Select[tuple[UtilityBill]]:
-    return select(UtilityBill).options(joinedload(UtilityBill.utility)).order_by(UtilityBill.received_date.desc(), UtilityBill.id.desc())
-
-
-def expected_rows(session: Session, year: int) -> list[ExpectedRow]:
-    active_types = session.scalars(select(UtilityType).where(UtilityType.is_active.is_(True)).order_by(UtilityType.name_hr)).all()
-    results: list[ExpectedRow] = []
-    for utility in active_types:
-        for month in range(1, 13):
-            consumption = date(year, month, 1)
-            stats = session.execute(
-                select(
-                    func.count(UtilityBill.id),
-                    func.min(UtilityBill.received_date),
-                    func.sum(case((UtilityBill.is_paid.is_(True), 1), else_=0)),
-                )
-                .where(UtilityBill.utility_type == utility.code)
-                .where(UtilityBill.consumption_month == consumption)
-            ).one()
-            received_count, first_received, charged_count = stats
-            results.append(
-                ExpectedRow(
-                    utility_type=utility.code,
-                    utility_name=utility.name_hr,
-                    consumption_month=consumption,
-                    received=bool(received_count),
-                    first_received_date=first_received,
-                    charged=bool(charged_count),
-                )
+    return _BILLS_STMT
+
+
+def active_utility_types_query() -> Select[tuple[UtilityType]]:
+    return _ACTIVE_UTILITY_TYPES_STMT
+
+
+def expected_rows(session: Session, year: int, *, utility_code: Optional[str] = None, month: Optional[int] = None) -> Iterator[ExpectedRow]:
+    stats_stmt = select(
+        UtilityBill.utility_type,
+        UtilityBill.consumption_month,
+        func.count(UtilityBill.id),
+        func.min(UtilityBill.received_date),
+        func.sum(case((UtilityBill.is_paid.is_(True), 1), else_=0)),
+    ).group_by(UtilityBill.utility_type, UtilityBill.consumption_month)
+    if utility_code is not None:
+        stats_stmt = stats_stmt.where(UtilityBill.utility_type == utility_code)
+    if month is not None:
+        months = [date(year, month, 1)]
+        stats_stmt = stats_stmt.where(UtilityBill.consumption_month == months[0])
+    else:
+        months = [date(year, number, 1) for number in range(1, 13)]
+        stats_stmt = stats_stmt.where(UtilityBill.consumption_month >= months[0], UtilityBill.consumption_month <= months[-1])
+
+    active_types = get_active_keys(session).utility_names
+    if utility_code is not None:
+        active_types = tuple(item for item in active_types if item[0] == utility_code)
+    stats = {(code, consumption): (count, first, paid) for code, consumption, count, first, paid in session.execute(stats_stmt)}
+    for code, name in active_types:
+        for consumption in months:
+            received_count, first_received, charged_count = stats.get((code, consumption), (0, None, 0))
+            yield ExpectedRow(
+                utility_type=code,
+                utility_name=name,
+                consumption_month=consumption,
+                received=bool(received_count),
+                first_received_date=first_received,
+                charged=bool(charged_count),
             )
-    return results
+
+
+def expected_missing_count(session: Session, year: int) -> int:
+    months = [date(year, number, 1) for number in range(1, 13)]
+    active_codes = get_active_keys(session).utility_codes
+    received_pairs = (
+        select(UtilityBill.utility_type, UtilityBill.consumption_month)
+        .where(UtilityBill.utility_type.in_(active_codes), UtilityBill.consumption_month.in_(months))
+        .distinct()
+        .subquery()
+    )
+    return len(active_codes) * len(months) - session.scalar(select(func.count()).select_from(received_pairs))
 
 
 def close_billing_month(session: Session, month: date) -> None:
     with session.begin_nested():
         billing = ensure_billing_month(session, month)
         billing.is_closed = True
-        billing.closed_at = datetime.utcnow()
-        today = date.today()
-        bills = session.scalars(select(UtilityBill).where(UtilityBill.billing_month == month)).all()
-        for bill in bills:
-            bill.is_paid = True
-            bill.paid_date = today
+        billing.closed_at = utc_now()
+        session.execute(
+            update(UtilityBill).where(UtilityBill.billing_month == month).values(is_paid=True, paid_date=date.today()),
+            execution_options={"synchronize_session": False},
+        )
 
 
 def reopen_billing_month(session: Session, month: date) -> None:
@@ -193,15 +326,39 @@ def reopen_billing_month(session: Session, month: date) -> None:
         billing = ensure_billing_month(session, month)
         billing.is_closed = False
         billing.closed_at = None
-        bills = session.scalars(select(UtilityBill).where(UtilityBill.billing_month == month)).all()
-        for bill in bills:
-            bill.is_paid = False
-            bill.paid_date = None
+        session.execute(
+            update(UtilityBill).where(UtilityBill.billing_month == month).values(is_paid=False, paid_date=None),
+            execution_options={"synchronize_session": False},
+        )
+
+
+def checkpoint_database() -> None:
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def export_database(target: Path) -> None:
+    with closing(sqlite3.connect(DB_PATH)) as source, closing(sqlite3.connect(target)) as destination:
+        source.backup(destination)
 
 
 def import_database(upload_path: Path) -> tuple[bool, str]:
     try:
-        shutil.copyfile(upload_path, DB_PATH)
+        with closing(sqlite3.connect(upload_path)) as source:
+            (integrity,) = source.execute("PRAGMA integrity_check").fetchone()
+    except sqlite3.Error as exc:
+        return False, f"Uvoz baze nije uspio: {exc}"
+    if integrity != "ok":
+        return False, f"Uvoz baze nije uspio: {integrity}"
+    checkpoint_database()
+    engine.dispose()
+    os.replace(upload_path, DB_PATH)
+    for suffix in ("-wal", "-shm"):
+        Path(f"{DB_PATH}{suffix}").unlink(missing_ok=True)
+    invalidate_settings()
+    invalidate_lookups()
+    invalidate_data_etag()
+    try:
         os.execv(sys.executable, [sys.executable, "main.py"])
     except Exception as exc:  # noqa: BLE001
         return False, f"Baza je uvezena, ali automatski restart nije uspio: {exc}"
@@ -5,6 +5,9 @@ import re
 import sys
 from pathlib import Path
 
+_LEGACY_UNION_RE = re.compile(r"\b([A-Za-z_][A-Za-z0-9_\[\], ]*?)\s*\|\s*None\b")
+_LEGACY_PROBE_RE = re.compile(r"\b\w+\s*\|\s*None\b")
+
 
 def _ensure_optional_import(content: str) -> str:
     if re.search(r"from typing import .*\bOptional\b", content):
@@ -15,13 +18,7 @@ def _ensure_optional_import(content: str) -> str:
 
 
 def _rewrite_legacy_unions(content: str) -> tuple[str, int]:
-    pattern = re.compile(r"\b([A-Za-z_][A-Za-z0-9_\[\], ]*)\s*\|\s*None\b")
-
-    def repl(match: re.Match[str]) -> str:
-        left = match.group(1).strip()
-        return f"Optional[{left}]"
-
-    updated, count = pattern.subn(repl, content)
+    updated, count = _LEGACY_UNION_RE.subn(r"Optional[\1]", content)
     if count:
         updated = _ensure_optional_import(updated)
     return updated, count
@@ -45,12 +42,14 @@ def main() -> int:
         return 1
 
     content = main_path.read_text(encoding="utf-8", errors="replace")
-    has_legacy = bool(re.search(r"\b\w+\s*\|\s*None\b", content))
+    has_legacy = bool(_LEGACY_PROBE_RE.search(content))
+    reloaded = content
 
     if has_legacy:
         print("[GREŠKA] Ova kopija main.py još sadrži staru anotaciju tipa `x | None`.")
         if args.fix:
             fixed, count = _rewrite_legacy_unions(content)
+            reloaded = fixed
             if count:
                 backup_path = main_path.with_suffix(".py.bak")
                 backup_path.write_text(content, encoding="utf-8")
@@ -62,8 +61,7 @@ def main() -> int:
             print("         Pokrenite `python doctor.py --fix` za automatski pokušaj popravka ili napravite `git pull`.")
             return 1
 
-    reloaded = main_path.read_text(encoding="utf-8", errors="replace")
-    if re.search(r"\b\w+\s*\|\s*None\b", reloaded):
+    if _LEGACY_PROBE_RE.search(reloaded):
         print("[GREŠKA] I dalje postoje zastarjele anotacije. Napravite `git pull` i osvježite .venv.")
         return 1
 
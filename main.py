@@ -1,12 +1,15 @@
 from __future__ import annotations
 
+import contextlib
+import functools
+import re
 import shutil
 import sys
 import tempfile
-from datetime import date, datetime
-from decimal import Decimal, InvalidOperation
+from datetime import date
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
 from pathlib import Path
-from typing import Dict, List, Optional, Union
+from typing import Dict, Optional, Sequence, Tuple, Union
 
 from pydantic import __version__ as PYDANTIC_VERSION
 
@@ -19,82 +22,173 @@ if int(PYDANTIC_VERSION.split(".", maxsplit=1)[0]) < 2:
     )
 
 from fastapi import Depends, FastAPI, File, Form, HTTPException, Request, UploadFile
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.responses import FileResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import func, select
-from sqlalchemy.orm import Session
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from sqlalchemy import desc, func, literal, null, select, union_all
+from sqlalchemy.orm import Session, raiseload, selectinload
+from starlette.background import BackgroundTask
 
 from app.db import DB_PATH, SessionLocal, get_session
-from app.models import Apartment, BillingMonth, UtilityBill, UtilityType
+from app.models import Apartment, BillingMonth, Setting, UtilityBill, UtilityType
 from app.services import (
     HR_MONTHS,
+    SettingsSnapshot,
+    active_utility_types_query,
     close_billing_month,
     compute_billing_month,
     current_billing_month,
+    data_etag,
+    expected_missing_count,
+    export_database,
     expected_rows,
     format_date_hr,
     format_money_hr,
+    get_active_keys,
+    get_closed_months,
     get_settings,
     import_database,
     init_db,
+    invalidate_lookups,
+    invalidate_settings,
     month_label_hr,
+    needs_init,
     prev_month,
     reopen_billing_month,
     validate_month_first,
 )
 
-app = FastAPI(title="Evidencija računa")
-app.mount("/static", StaticFiles(directory="app/static"), name="static")
-templates = Jinja2Templates(directory="app/templates")
+_CENTS = Decimal("0.01")
+_COMMA_DOT = str.maketrans({",": "."})
+_HR_MONTHS_CAP = tuple(name.capitalize() for name in HR_MONTHS)
+_YEAR_MONTH_DAY_RE = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})$", re.ASCII)
+_MONTH_RE = re.compile(r"^(?:(?P<y1>\d{4})-(?P<m1>\d{1,2})(?:-(?P<d1>\d{1,2}))?|(?P<m2>\d{1,2})[./-](?P<y2>\d{4}))$", re.ASCII)
+_DAY_MONTH_YEAR_RE = re.compile(r"^(\d{1,2})\.(\d{1,2})\.(\d{4})$", re.ASCII)
 
 
-@app.on_event("startup")
-def startup() -> None:
+@contextlib.asynccontextmanager
+async def lifespan(_app: FastAPI):
     with SessionLocal() as session:
-        init_db(session)
+        if needs_init(session):
+            init_db(session)
+        get_settings(session)
+        get_active_keys(session)
+    for name in templates.env.list_templates(extensions=["html"]):
+        templates.env.get_template(name)
+    yield
+
+
+app = FastAPI(title="Evidencija računa", lifespan=lifespan)
+app.mount("/static", StaticFiles(directory="app/static"), name="static")
+JINJA_CACHE_DIR = Path(".jinja_cache")
+JINJA_CACHE_DIR.mkdir(exist_ok=True)
+templates = Jinja2Templates(
+    env=Environment(
+        loader=FileSystemLoader("app/templates"),
+        autoescape=True,
+        auto_reload=False,
+        cache_size=400,
+        bytecode_cache=FileSystemBytecodeCache(directory=str(JINJA_CACHE_DIR), pattern="%s.cache"),
+    )
+)
+
+templates.env.filters["date_hr"] = format_date_hr
+templates.env.filters["money_hr"] = format_money_hr
+
+_CTX_BASE = {"month_label_hr": month_label_hr}
+
+
+class DatabaseFileResponse(FileResponse):
+    chunk_size = 1 << 20
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return None
+
+
+def with_etag(response: Response, etag: str) -> Response:
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def current_settings(session: Session = Depends(get_session)) -> SettingsSnapshot:
+    return get_settings(session)
+
+
+def current_date() -> date:
+    return date.today()
 
 
 def ctx(request: Request, **kwargs):
-    base = {
-        "request": request,
-        "format_date_hr": format_date_hr,
-        "format_money_hr": format_money_hr,
-        "month_label_hr": month_label_hr,
-    }
-    base.update(kwargs)
-    return base
+    return {**_CTX_BASE, "request": request, **kwargs}
+
+
+def _iso_date_parts(raw: str) -> Optional[tuple[int, int, int]]:
+    if (
+        len(raw) == 10
+        and raw.isascii()
+        and raw[4] == "-"
+        and raw[7] == "-"
+        and raw[:4].isdigit()
+        and raw[5:7].isdigit()
+        and raw[8:].isdigit()
+    ):
+        return int(raw[:4]), int(raw[5:7]), int(raw[8:])
+    return None
+
+
+@functools.lru_cache(maxsize=256)
+def _date_value(raw: str) -> Optional[date]:
+    parts = _iso_date_parts(raw)
+    if parts is None:
+        match = _YEAR_MONTH_DAY_RE.match(raw)
+        if match:
+            parts = int(match[1]), int(match[2]), int(match[3])
+        else:
+            match = _DAY_MONTH_YEAR_RE.match(raw)
+            parts = (int(match[3]), int(match[2]), int(match[1])) if match else None
+    if parts is None:
+        return None
+    try:
+        return date(*parts)
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=256)
+def _month_value(raw: str) -> Optional[date]:
+    match = _MONTH_RE.match(raw)
+    if match is None:
+        return None
+    year, month, day = match["y1"] or match["y2"], match["m1"] or match["m2"], match["d1"]
+    try:
+        return date(int(year), int(month), int(day) if day else 1).replace(day=1)
+    except ValueError:
+        return None
 
 
 def parse_date(raw: str, field: str) -> date:
-    raw = (raw or "").strip()
-    for pattern in ("%Y-%m-%d", "%d.%m.%Y"):
-        try:
-            return datetime.strptime(raw, pattern).date()
-        except ValueError:
-            pass
-    raise HTTPException(status_code=400, detail=f"Neispravan datum za {field}.")
+    value = _date_value((raw or "").strip())
+    if value is None:
+        raise HTTPException(status_code=400, detail=f"Neispravan datum za {field}.")
+    return value
 
 
 def parse_month(raw: str, field: str) -> date:
-    raw = (raw or "").strip()
-    candidates = [
-        ("%Y-%m", lambda d: date(d.year, d.month, 1)),
-        ("%Y-%m-%d", lambda d: date(d.year, d.month, 1)),
-        ("%m/%Y", lambda d: date(d.year, d.month, 1)),
-        ("%m-%Y", lambda d: date(d.year, d.month, 1)),
-        ("%m.%Y", lambda d: date(d.year, d.month, 1)),
-    ]
-    for pattern, normalize in candidates:
-        try:
-            return normalize(datetime.strptime(raw, pattern).date())
-        except ValueError:
-            pass
-    raise HTTPException(status_code=400, detail=f"Neispravan mjesec za {field}.")
+    value = _month_value((raw or "").strip())
+    if value is None:
+        raise HTTPException(status_code=400, detail=f"Neispravan mjesec za {field}.")
+    return value
 
 
 def parse_amount(raw: str) -> Decimal:
-    normalized = (raw or "").strip().replace(" ", "").replace(",", ".")
+    normalized = (raw or "").strip()
+    if "," in normalized or " " in normalized:
+        normalized = normalized.replace(" ", "").translate(_COMMA_DOT)
     try:
         return Decimal(normalized)
     except InvalidOperation as exc:
@@ -102,37 +196,38 @@ def parse_amount(raw: str) -> Decimal:
 
 
 def month_choice_label(month_number: int) -> str:
-    return HR_MONTHS[month_number - 1].capitalize()
+    return _HR_MONTHS_CAP[month_number - 1]
 
 
-def month_select_options() -> List[Dict[str, Union[str, int]]]:
-    return [{"value": month, "label": month_choice_label(month)} for month in range(1, 13)]
+MONTH_OPTIONS: Tuple[Dict[str, Union[str, int]], ...] = tuple({"value": month, "label": month_choice_label(month)} for month in range(1, 13))
 
 
-def year_select_options(active_year: int) -> list[int]:
-    return [active_year - 1, active_year, active_year + 1]
+@functools.lru_cache(maxsize=8)
+def year_select_options(active_year: int) -> Tuple[int, ...]:
+    return (active_year - 1, active_year, active_year + 1)
 
 
-def parse_consumption_month(month_value: str, year_value: str, fallback_raw: str, field: str) -> date:
-    if month_value and year_value:
-        try:
-            month_int = int(month_value)
-            year_int = int(year_value)
-            return date(year_int, month_int, 1)
-        except ValueError as exc:
-            raise HTTPException(status_code=400, detail=f"Neispravan mjesec za {field}.") from exc
-    return parse_month(fallback_raw, field)
+def active_bill_form_choices(session: Session) -> Dict[str, Sequence[Union[UtilityType, Apartment]]]:
+    return {
+        "utility_types": session.scalars(active_utility_types_query()).all(),
+        "apartments": session.scalars(select(Apartment).where(Apartment.is_active.is_(True)).order_by(Apartment.name)).all(),
+    }
 
 
 @app.get("/")
-def dashboard(request: Request, session: Session = Depends(get_session)):
-    settings = get_settings(session)
-    curr = current_billing_month(date.today(), settings.billing_day)
-    bills_in_curr = session.scalar(select(func.count()).select_from(UtilityBill).where(UtilityBill.billing_month == curr))
-    closed_curr = session.scalar(
-        select(func.count()).select_from(BillingMonth).where(BillingMonth.billing_month == curr, BillingMonth.is_closed.is_(True))
-    )
-    late_unreceived = [r for r in expected_rows(session, settings.active_year) if not r.received]
+def dashboard(
+    request: Request,
+    session: Session = Depends(get_session),
+    settings: SettingsSnapshot = Depends(current_settings),
+    today: date = Depends(current_date),
+):
+    curr = current_billing_month(today, settings.billing_day)
+    bills_in_curr, closed_curr = session.execute(
+        select(
+            select(func.count()).select_from(UtilityBill).where(UtilityBill.billing_month == curr).scalar_subquery(),
+            select(BillingMonth.billing_month).where(BillingMonth.billing_month == curr, BillingMonth.is_closed.is_(True)).exists(),
+        )
+    ).one()
     return templates.TemplateResponse(
         "dashboard.html",
         ctx(
@@ -142,36 +237,42 @@ def dashboard(request: Request, session: Session = Depends(get_session)):
             rent_display_month=prev_month(curr),
             bills_in_curr=bills_in_curr,
             is_current_closed=bool(closed_curr),
-            missing_count=len(late_unreceived),
+            missing_count=expected_missing_count(session, settings.active_year),
         ),
     )
 
 
 @app.get("/bills")
 def bills_list(request: Request, session: Session = Depends(get_session)):
-    bills = session.scalars(select(UtilityBill).order_by(UtilityBill.received_date.desc(), UtilityBill.id.desc())).all()
-    utility_map = {u.code: u.name_hr for u in session.scalars(select(UtilityType)).all()}
-    apartment_map = {a.id: a.name for a in session.scalars(select(Apartment)).all()}
-    closed_months = {m.billing_month for m in session.scalars(select(BillingMonth).where(BillingMonth.is_closed.is_(True))).all()}
-    return templates.TemplateResponse(
-        "bills_list.html",
-        ctx(request, bills=bills, utility_map=utility_map, apartment_map=apartment_map, closed_months=closed_months),
+    etag = data_etag()
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
+    stmt = (
+        select(
+            UtilityBill,
+            UtilityType.name_hr.label("utility_name"),
+            Apartment.name.label("apartment_name"),
+            BillingMonth.is_closed,
+        )
+        .join(UtilityType, UtilityType.code == UtilityBill.utility_type)
+        .outerjoin(Apartment, Apartment.id == UtilityBill.apartment_id)
+        .outerjoin(BillingMonth, BillingMonth.billing_month == UtilityBill.billing_month)
+        .order_by(UtilityBill.received_date.desc(), UtilityBill.id.desc())
     )
+    rows = session.execute(stmt.execution_options(yield_per=200))
+    return with_etag(templates.TemplateResponse("bills_list.html", ctx(request, rows=rows)), etag)
 
 
 @app.get("/bills/new")
-def bill_new(request: Request, session: Session = Depends(get_session)):
-    settings = get_settings(session)
-    utility_types = session.scalars(select(UtilityType).where(UtilityType.is_active.is_(True)).order_by(UtilityType.name_hr)).all()
-    apartments = session.scalars(select(Apartment).where(Apartment.is_active.is_(True)).order_by(Apartment.name)).all()
+def bill_new(request: Request, session: Session = Depends(get_session), settings: SettingsSnapshot = Depends(current_settings)):
     return templates.TemplateResponse(
         "bill_form.html",
         ctx(
             request,
             bill=None,
-            utility_types=utility_types,
-            apartments=apartments,
-            month_options=month_select_options(),
+            **active_bill_form_choices(session),
+            month_options=MONTH_OPTIONS,
             year_options=year_select_options(settings.active_year),
             settings=settings,
             error=None,
@@ -180,12 +281,16 @@ def bill_new(request: Request, session: Session = Depends(get_session)):
 
 
 @app.get("/bills/{bill_id}/edit")
-def bill_edit(bill_id: int, request: Request, session: Session = Depends(get_session)):
+def bill_edit(
+    bill_id: int,
+    request: Request,
+    session: Session = Depends(get_session),
+    settings: SettingsSnapshot = Depends(current_settings),
+):
     bill = session.get(UtilityBill, bill_id)
     if not bill:
         raise HTTPException(status_code=404, detail="Račun nije pronađen.")
-    settings = get_settings(session)
-    utility_types = session.scalars(select(UtilityType).where(UtilityType.is_active.is_(True)).order_by(UtilityType.name_hr)).all()
+    utility_types = session.scalars(active_utility_types_query()).all()
     apartments = session.scalars(select(Apartment).order_by(Apartment.name)).all()
     return templates.TemplateResponse(
         "bill_form.html",
@@ -194,7 +299,7 @@ def bill_edit(bill_id: int, request: Request, session: Session = Depends(get_ses
             bill=bill,
             utility_types=utility_types,
             apartments=apartments,
-            month_options=month_select_options(),
+            month_options=MONTH_OPTIONS,
             year_options=year_select_options(settings.active_year),
             settings=settings,
             error=None,
@@ -239,12 +344,10 @@ def bill_save(
     amount: str = Form(...),
     note: str = Form(default=""),
     session: Session = Depends(get_session),
+    settings: SettingsSnapshot = Depends(current_settings),
+    today: date = Depends(current_date),
 ):
-    settings = get_settings(session)
-    utility_types = session.scalars(select(UtilityType).where(UtilityType.is_active.is_(True)).order_by(UtilityType.name_hr)).all()
-    apartments = session.scalars(select(Apartment).where(Apartment.is_active.is_(True)).order_by(Apartment.name)).all()
-    active_codes = {item.code for item in utility_types}
-    active_apartment_ids = {item.id for item in apartments}
+    active_keys = get_active_keys(session)
     form_bill = build_bill_form_data(
         bill_id,
         apartment_id,
@@ -257,143 +360,76 @@ def bill_save(
         note,
     )
 
-    if apartment_id not in active_apartment_ids:
+    def err(message: str, status_code: int = 400):
         return templates.TemplateResponse(
             "bill_form.html",
             ctx(
                 request,
                 bill=form_bill,
-                utility_types=utility_types,
-                apartments=apartments,
-                month_options=month_select_options(),
+                **active_bill_form_choices(session),
+                month_options=MONTH_OPTIONS,
                 year_options=year_select_options(settings.active_year),
                 settings=settings,
-                error="Odabrani stan nije valjan ili više nije aktivan.",
+                error=message,
             ),
-            status_code=400,
+            status_code=status_code,
         )
 
-    if utility_type not in active_codes:
-        return templates.TemplateResponse(
-            "bill_form.html",
-            ctx(
-                request,
-                bill=form_bill,
-                utility_types=utility_types,
-                apartments=apartments,
-                month_options=month_select_options(),
-                year_options=year_select_options(settings.active_year),
-                settings=settings,
-                error="Odabrani tip režije nije valjan ili više nije aktivan.",
-            ),
-            status_code=400,
-        )
+    if apartment_id not in active_keys.apartment_ids:
+        return err("Odabrani stan nije valjan ili više nije aktivan.")
+
+    if utility_type not in active_keys.utility_codes:
+        return err("Odabrani tip režije nije valjan ili više nije aktivan.")
+    if consumption_month_month.isdigit() and consumption_month_year.isdigit():
+        try:
+            consumption = date(int(consumption_month_year), int(consumption_month_month), 1)
+        except ValueError:
+            return err("Neispravan mjesec za mjesec potrošnje.")
+    else:
+        try:
+            consumption = parse_month(consumption_month, "mjesec potrošnje")
+        except HTTPException as exc:
+            return err(exc.detail)
     try:
-        consumption = parse_consumption_month(consumption_month_month, consumption_month_year, consumption_month, "mjesec potrošnje")
         received = parse_date(received_date, "datum primitka")
         amount_decimal = parse_amount(amount)
     except HTTPException as exc:
-        return templates.TemplateResponse(
-            "bill_form.html",
-            ctx(
-                request,
-                bill=form_bill,
-                utility_types=utility_types,
-                apartments=apartments,
-                month_options=month_select_options(),
-                year_options=year_select_options(settings.active_year),
-                settings=settings,
-                error=exc.detail,
-            ),
-            status_code=400,
-        )
+        return err(exc.detail)
 
     if not validate_month_first(consumption):
-        return templates.TemplateResponse(
-            "bill_form.html",
-            ctx(
-                request,
-                bill=form_bill,
-                utility_types=utility_types,
-                apartments=apartments,
-                month_options=month_select_options(),
-                year_options=year_select_options(settings.active_year),
-                settings=settings,
-                error="Mjesec potrošnje mora biti prvi dan mjeseca.",
-            ),
-            status_code=400,
-        )
-    if received > date.today():
-        return templates.TemplateResponse(
-            "bill_form.html",
-            ctx(
-                request,
-                bill=form_bill,
-                utility_types=utility_types,
-                apartments=apartments,
-                month_options=month_select_options(),
-                year_options=year_select_options(settings.active_year),
-                settings=settings,
-                error="Datum primitka ne smije biti u budućnosti.",
-            ),
-            status_code=400,
-        )
+        return err("Mjesec potrošnje mora biti prvi dan mjeseca.")
+    if received > today:
+        return err("Datum primitka ne smije biti u budućnosti.")
     if amount_decimal <= 0:
-        return templates.TemplateResponse(
-            "bill_form.html",
-            ctx(
-                request,
-                bill=form_bill,
-                utility_types=utility_types,
-                apartments=apartments,
-                month_options=month_select_options(),
-                year_options=year_select_options(settings.active_year),
-                settings=settings,
-                error="Iznos mora biti pozitivan.",
-            ),
-            status_code=400,
-        )
+        return err("Iznos mora biti pozitivan.")
 
     billing_month = compute_billing_month(received, settings.billing_day)
-    month_status = session.get(BillingMonth, billing_month)
-    if month_status and month_status.is_closed and bill_id is None:
-        return templates.TemplateResponse(
-            "bill_form.html",
-            ctx(
-                request,
-                bill=form_bill,
-                utility_types=utility_types,
-                apartments=apartments,
-                month_options=month_select_options(),
-                year_options=year_select_options(settings.active_year),
-                settings=settings,
-                error="Obračunski mjesec je zatvoren. Prvo ga ponovno otvorite.",
-            ),
-            status_code=400,
-        )
+    closed_months = get_closed_months(session)
+    if billing_month in closed_months and bill_id is None:
+        return err("Obračunski mjesec je zatvoren. Prvo ga ponovno otvorite.")
 
     if bill_id:
         bill = session.get(UtilityBill, bill_id)
         if not bill:
             raise HTTPException(status_code=404, detail="Račun nije pronađen.")
-        existing_month = session.get(BillingMonth, bill.billing_month)
-        if existing_month and existing_month.is_closed:
+        if bill.billing_month in closed_months:
             raise HTTPException(status_code=400, detail="Račun iz zatvorenog mjeseca nije moguće mijenjati.")
-        if month_status and month_status.is_closed and bill.billing_month != billing_month:
+        if billing_month in closed_months and bill.billing_month != billing_month:
             raise HTTPException(status_code=400, detail="Ciljani obračunski mjesec je zatvoren.")
     else:
-        bill = UtilityBill(created_at=datetime.utcnow())
+        bill = UtilityBill()
         session.add(bill)
 
+    if bill.billing_month != billing_month:
+        bill.is_paid = False
+        bill.paid_date = None
     bill.apartment_id = apartment_id
     bill.utility_type = utility_type
     bill.consumption_month = consumption
     bill.received_date = received
-    bill.amount = amount_decimal.quantize(Decimal("0.01"))
+    bill.amount = amount_decimal.quantize(_CENTS, rounding=ROUND_HALF_UP)
     bill.billing_month = billing_month
     bill.note = note or None
-    bill.is_paid = False
-    bill.paid_date = None
 
     session.commit()
     return RedirectResponse(url="/bills", status_code=303)
@@ -414,21 +450,38 @@ def bill_delete(bill_id: int, session: Session = Depends(get_session)):
 
 @app.get("/monthly-charges")
 def monthly_charges(request: Request, session: Session = Depends(get_session)):
-    months_from_bills = {m for (m,) in session.execute(select(UtilityBill.billing_month).distinct()).all()}
-    months_from_status = {m.billing_month: m for m in session.scalars(select(BillingMonth)).all()}
-    all_months = sorted(months_from_bills.union(months_from_status.keys()), reverse=True)
-    months = [months_from_status.get(month, BillingMonth(billing_month=month, is_closed=False, closed_at=None)) for month in all_months]
-    return templates.TemplateResponse("monthly_charges.html", ctx(request, months=months))
+    etag = data_etag()
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
+    untracked_months = (
+        select(UtilityBill.billing_month, literal(False), null())
+        .where(~select(BillingMonth.billing_month).where(BillingMonth.billing_month == UtilityBill.billing_month).exists())
+        .distinct()
+    )
+    stmt = union_all(select(BillingMonth.billing_month, BillingMonth.is_closed, BillingMonth.closed_at), untracked_months).order_by(
+        desc("billing_month")
+    )
+    months = session.execute(stmt).all()
+    return with_etag(templates.TemplateResponse("monthly_charges.html", ctx(request, months=months)), etag)
 
 
 @app.get("/monthly-charges/{month}")
-def monthly_charge_detail(month: str, request: Request, session: Session = Depends(get_session)):
+def monthly_charge_detail(
+    month: str,
+    request: Request,
+    session: Session = Depends(get_session),
+    settings: SettingsSnapshot = Depends(current_settings),
+):
     billing_month = parse_date(month, "obračunski mjesec")
-    settings = get_settings(session)
-    bills = session.scalars(select(UtilityBill).where(UtilityBill.billing_month == billing_month).order_by(UtilityBill.utility_type)).all()
-    utility_map = {u.code: u.name_hr for u in session.scalars(select(UtilityType)).all()}
-    apartment_map = {a.id: a.name for a in session.scalars(select(Apartment)).all()}
-    total_utility = sum((b.amount for b in bills), Decimal("0.00"))
+    bills = session.scalars(
+        select(UtilityBill)
+        .options(selectinload(UtilityBill.utility), selectinload(UtilityBill.apartment), raiseload("*"))
+        .where(UtilityBill.billing_month == billing_month)
+        .order_by(UtilityBill.utility_type)
+    ).all()
+    total_utility = session.scalar(select(func.coalesce(func.sum(UtilityBill.amount), 0)).where(UtilityBill.billing_month == billing_month))
+    total_utility = Decimal(str(total_utility)).quantize(_CENTS, rounding=ROUND_HALF_UP)
     grand_total = total_utility + settings.rent_amount
     month_record = session.get(BillingMonth, billing_month)
     return templates.TemplateResponse(
@@ -438,8 +491,6 @@ def monthly_charge_detail(month: str, request: Request, session: Session = Depen
             billing_month=billing_month,
             rent_month=prev_month(billing_month),
             bills=bills,
-            utility_map=utility_map,
-            apartment_map=apartment_map,
             total_utility=total_utility,
             rent_amount=settings.rent_amount,
             grand_total=grand_total,
@@ -465,15 +516,25 @@ def reopen_month(month: str, session: Session = Depends(get_session)):
 
 
 @app.get("/expected-bills")
-def expected_bills_page(request: Request, session: Session = Depends(get_session)):
-    settings = get_settings(session)
+def expected_bills_page(
+    request: Request,
+    session: Session = Depends(get_session),
+    settings: SettingsSnapshot = Depends(current_settings),
+):
+    etag = data_etag()
+    cached = not_modified(request, etag)
+    if cached is not None:
+        return cached
     rows = expected_rows(session, settings.active_year)
-    return templates.TemplateResponse("expected_bills.html", ctx(request, rows=rows, year=settings.active_year))
+    return with_etag(templates.TemplateResponse("expected_bills.html", ctx(request, rows=rows, year=settings.active_year)), etag)
 
 
 @app.get("/settings")
-def settings_page(request: Request, session: Session = Depends(get_session)):
-    settings = get_settings(session)
+def settings_page(
+    request: Request,
+    session: Session = Depends(get_session),
+    settings: SettingsSnapshot = Depends(current_settings),
+):
     types = session.scalars(select(UtilityType).order_by(UtilityType.name_hr)).all()
     apartments = session.scalars(select(Apartment).order_by(Apartment.name)).all()
     return templates.TemplateResponse("settings.html", ctx(request, settings=settings, utility_types=types, apartments=apartments, error=None))
@@ -486,8 +547,8 @@ def settings_save(
     billing_day: int = Form(...),
     active_year: int = Form(...),
     session: Session = Depends(get_session),
+    settings: SettingsSnapshot = Depends(current_settings),
 ):
-    settings = get_settings(session)
     types = session.scalars(select(UtilityType).order_by(UtilityType.name_hr)).all()
     apartments = session.scalars(select(Apartment).order_by(Apartment.name)).all()
     try:
@@ -497,21 +558,24 @@ def settings_save(
     if billing_day < 1 or billing_day > 28:
         return templates.TemplateResponse("settings.html", ctx(request, settings=settings, utility_types=types, apartments=apartments, error="Dan obračuna mora biti između 1 i 28."), status_code=400)
 
-    settings.rent_amount = rent.quantize(Decimal("0.01"))
-    settings.billing_day = billing_day
-    settings.active_year = active_year
+    settings_row = session.get(Setting, settings.id)
+    settings_row.rent_amount = rent.quantize(_CENTS, rounding=ROUND_HALF_UP)
+    settings_row.billing_day = billing_day
+    settings_row.active_year = active_year
     session.commit()
+    invalidate_settings()
     return RedirectResponse(url="/settings", status_code=303)
 
 
 @app.post("/settings/utility-type/add")
 def utility_type_add(code: str = Form(...), name_hr: str = Form(...), session: Session = Depends(get_session)):
     safe_code = code.strip().lower().replace(" ", "_")
-    exists = session.scalar(select(func.count()).select_from(UtilityType).where(UtilityType.code == safe_code))
-    if exists:
+    exists = session.scalar(select(UtilityType.id).where(UtilityType.code == safe_code).limit(1))
+    if exists is not None:
         raise HTTPException(status_code=400, detail="Šifra već postoji.")
     session.add(UtilityType(code=safe_code, name_hr=name_hr.strip(), is_active=True))
     session.commit()
+    invalidate_lookups()
     return RedirectResponse(url="/settings", status_code=303)
 
 
@@ -522,6 +586,7 @@ def utility_type_deactivate(type_id: int, session: Session = Depends(get_session
         raise HTTPException(status_code=404, detail="Tip nije pronađen.")
     utility_type.is_active = False
     session.commit()
+    invalidate_lookups()
     return RedirectResponse(url="/settings", status_code=303)
 
 
@@ -530,11 +595,12 @@ def apartment_add(name: str = Form(...), session: Session = Depends(get_session)
     apartment_name = name.strip()
     if not apartment_name:
         raise HTTPException(status_code=400, detail="Naziv stana je obavezan.")
-    exists = session.scalar(select(func.count()).select_from(Apartment).where(Apartment.name == apartment_name))
-    if exists:
+    exists = session.scalar(select(Apartment.id).where(Apartment.name == apartment_name).limit(1))
+    if exists is not None:
         raise HTTPException(status_code=400, detail="Stan s tim nazivom već postoji.")
     session.add(Apartment(name=apartment_name, is_active=True))
     session.commit()
+    invalidate_lookups()
     return RedirectResponse(url="/settings", status_code=303)
 
 
@@ -543,26 +609,38 @@ def apartment_deactivate(apartment_id: int, session: Session = Depends(get_sessi
     apartment = session.get(Apartment, apartment_id)
     if not apartment:
         raise HTTPException(status_code=404, detail="Stan nije pronađen.")
-    active_count = session.scalar(select(func.count()).select_from(Apartment).where(Apartment.is_active.is_(True)))
-    if apartment.is_active and active_count <= 1:
+    has_other_active = session.scalar(select(Apartment.id).where(Apartment.is_active.is_(True), Apartment.id != apartment_id).limit(1))
+    if apartment.is_active and has_other_active is None:
         raise HTTPException(status_code=400, detail="Mora postojati barem jedan aktivan stan.")
     apartment.is_active = False
     session.commit()
+    invalidate_lookups()
     return RedirectResponse(url="/settings", status_code=303)
 
 
 @app.get("/backup/export")
 def backup_export():
-    return FileResponse(DB_PATH, media_type="application/x-sqlite3", filename="data.db")
+    with tempfile.NamedTemporaryFile(suffix=".db", delete=False) as f:
+        export_file = Path(f.name)
+    export_database(export_file)
+    return DatabaseFileResponse(
+        export_file,
+        stat_result=export_file.stat(),
+        media_type="application/x-sqlite3",
+        filename="data.db",
+        background=BackgroundTask(export_file.unlink, missing_ok=True),
+    )
 
 
 @app.post("/backup/import")
 def backup_import(request: Request, db_file: UploadFile = File(...), session: Session = Depends(get_session)):
-    temp_dir = Path(tempfile.mkdtemp())
-    temp_file = temp_dir / "uploaded.db"
-    with temp_file.open("wb") as f:
-        shutil.copyfileobj(db_file.file, f)
-    ok, message = import_database(temp_file)
+    upload_file = DB_PATH.with_suffix(".upload")
+    with upload_file.open("wb") as f:
+        shutil.copyfileobj(db_file.file, f, length=1 << 20)
+    try:
+        ok, message = import_database(upload_file)
+    finally:
+        upload_file.unlink(missing_ok=True)
     types = session.scalars(select(UtilityType).order_by(UtilityType.name_hr)).all()
     apartments = session.scalars(select(Apartment).order_by(Apartment.name)).all()
     return templates.TemplateResponse("settings.html", ctx(request, settings=get_settings(session), utility_types=types, apartments=apartments, error=message if not ok else None))